@@ -5,82 +5,185 @@ import os
 import argparse
 import bids2table as b2t2
 import json
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+# orjson parses bytes directly and is several times faster than json
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads  # type: ignore[assignment]
 
 # default table is too wide, keep only relevant columns
 PARSE_TAGS = ['dataset', 'sub', 'ses', 'acq', 'dir', 'run', 'echo',  'desc', 'datatype', 'suffix', 'ext', 'extra_entities', 'path']
+
+# sidecar reads are I/O bound, so use more threads than cores
+N_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+
+# BIDS entities to extract from sidecar paths
+PATH_ENTITIES = ['sub', 'ses', 'acq']
+
+# low-cardinality columns used as groupby/isin keys, stored as categoricals
+CATEGORICAL_COLS = ['sub', 'ses', 'acq', 'datatype', 'suffix', 'ext']
         
 
-def get_bids_df(ds_path, bids_table_index_path, read_bids_df=False, save_bids_df=False):
+def get_fingerprint(paths, *keys):
+    """
+    Get a hash of file paths and their modification times, together with extra keys.
+    """
+    fingerprint = hashlib.blake2b(digest_size=16)
+    for path in sorted(paths):
+        fingerprint.update(f"{path}:{os.stat(path).st_mtime_ns};".encode())
+    fingerprint.update(repr(keys).encode())
+    return fingerprint.hexdigest()
+
+def find_index_dirs(ds_path):
+    """
+    Find the top-level files and the participant, session and datatype directories of a BIDS dataset.
+    Their mtimes change whenever a file is added, removed or renamed in the indexed part of the dataset.
     """
-    Get bids dataframe from bids2table or read from csv if already saved.
+    paths = []
+    for dpath, dnames, fnames in os.walk(ds_path):
+        rel_path = os.path.relpath(dpath, ds_path)
+        depth = 0 if rel_path == os.curdir else rel_path.count(os.sep) + 1
+        if depth == 0:
+            paths.extend(os.path.join(dpath, fname) for fname in fnames)
+            dnames[:] = [dname for dname in dnames if dname.startswith('sub-')]
+        elif depth == 2:
+            # datatype directories (or session subdirectories) are stat'ed but not listed
+            paths.extend(os.path.join(dpath, dname) for dname in dnames)
+            dnames[:] = []
+        paths.append(dpath)
+    return paths
+
+def save_cache(df, cache_path):
+    """
+    Save a dataframe to the cache, removing the previous versions of the same table.
+    """
+    cache_dir, fname = os.path.split(cache_path)
+    table_name = fname.split('-')[0]
+    os.makedirs(cache_dir, exist_ok=True)
+    for old_cache_path in glob.glob(f"{cache_dir}/{table_name}-*.parquet"):
+        os.remove(old_cache_path)
+    df.to_parquet(cache_path, index=False)
+
+def get_bids_df(ds_path, bids_table_index_path, read_bids_df=False, save_bids_df=False, cache_dir=None):
+    """
+    Get bids dataframe from bids2table or read from parquet if already saved.
+    If cache_dir is given, the index from a previous run is reused if the dataset has not changed.
     """
     if read_bids_df:
-        # read dataframe from csv
+        # read dataframe from parquet (typed columns, no csv parsing)
         print(f"Reading bids_df from {bids_table_index_path}")
-        bids_df = pd.read_csv(bids_table_index_path, sep='\t')
+        bids_df = pd.read_parquet(bids_table_index_path, columns=PARSE_TAGS, dtype_backend='pyarrow')
 
     else:
-        # index with b2t2
-        print(f"Indexing BIDS dataset from {ds_path}...")
-        tab = b2t2.index_dataset(ds_path)
-        bids_df = tab.to_pandas(types_mapper=pd.ArrowDtype)
-        bids_df = bids_df[PARSE_TAGS]
-
-        # ensure sub, ses are strings
-        bids_df['sub'] = bids_df['sub'].astype(str)
-        bids_df['ses'] = bids_df['ses'].astype(str)        
-
-        # save dataframe to csv
+        cache_path = None
+        if cache_dir:
+            fingerprint = get_fingerprint(find_index_dirs(ds_path), PARSE_TAGS)
+            cache_path = f"{cache_dir}/bids_df-{fingerprint}.parquet"
+
+        if cache_path and os.path.exists(cache_path):
+            print(f"Loading cached bids_df from {cache_path}")
+            bids_df = pd.read_parquet(cache_path, dtype_backend='pyarrow')
+
+        else:
+            # index with b2t2
+            print(f"Indexing BIDS dataset from {ds_path}...")
+            tab = b2t2.index_dataset(ds_path)
+            # select columns before converting, dropped columns are never materialized
+            bids_df = tab.select(PARSE_TAGS).to_pandas(types_mapper=pd.ArrowDtype)
+
+            # ensure sub, ses are strings
+            bids_df['sub'] = bids_df['sub'].astype(str)
+            bids_df['ses'] = bids_df['ses'].astype(str)
+
+            if cache_path:
+                save_cache(bids_df, cache_path)
+
+        # save dataframe to parquet
         if save_bids_df:        
-            bids_df.to_csv(bids_table_index_path, index=False, sep='\t')
+            bids_df.to_parquet(bids_table_index_path, index=False)
             print(f"Dataframe saved to {bids_table_index_path}")
 
     return bids_df
 
-def get_scanner_metadata(ds_path, bids_df, bids_table_metadata_path, scanner_metadata, read_metadata_df=False, save_metadata_df=False):
+def read_sidecar_metadata(json_file, ds_path, sidecar_tags):
+    """
+    Read scanner metadata values (in sidecar_tags order) from a single JSON sidecar file.
+    """
+    json_file_path = os.path.join(ds_path, json_file)
+    with open(json_file_path, 'rb') as f:
+        json_data = json_loads(f.read())
+
+    return [json_data.get(tag) for tag in sidecar_tags]
+
+def find_t1w_json_files(ds_path):
+    """
+    Find T1w JSON sidecar files (relative to ds_path) in the participant/session anat directories.
+    """
+    t1w_json_files = []
+    for dpath, dnames, fnames in os.walk(ds_path):
+        # only descend into participant, session and anat directories
+        dnames[:] = sorted(dname for dname in dnames if dname.startswith(('sub-', 'ses-')) or dname == 'anat')
+        if os.path.basename(dpath) == 'anat':
+            t1w_json_files.extend(
+                os.path.relpath(os.path.join(dpath, fname), ds_path) for fname in sorted(fnames) if fname.endswith('_T1w.json')
+            )
+    return t1w_json_files
+
+def get_scanner_metadata(ds_path, bids_table_metadata_path, scanner_metadata, read_metadata_df=False, save_metadata_df=False, cache_dir=None):
     """
     Extract scanner metadata from JSON sidecar files.
+    If cache_dir is given, the metadata from a previous run is reused if the sidecar files have not changed.
     """
 
     if read_metadata_df:
-        # read dataframe from csv
+        # read dataframe from csv (labels as strings to keep leading zeros, like the bids_df parquet)
         print(f"Reading metadata_df from {bids_table_metadata_path}")
-        metadata_df = pd.read_csv(bids_table_metadata_path, sep='\t')
+        metadata_df = pd.read_csv(bids_table_metadata_path, sep='\t', dtype={'sub': str, 'ses': str})
 
     else:
-        # get single T1w json files from bids_df per participant (bids to table does not list jsons...)
-        t1w_nii_files = bids_df[(bids_df['datatype'] == 'anat') & (bids_df['suffix'] == 'T1w') & (bids_df['ext'] == '.nii.gz')]['path'].unique()
-        print(f"Number of T1w json files: {len(t1w_nii_files)}")
-        t1w_json_files = [f.replace('.nii.gz', '.json') for f in t1w_nii_files]
-
-        metadata_list = []
-        for json_file in t1w_json_files:
-            json_file_path = f"{ds_path}/{json_file}"
-            with open(json_file_path, 'r') as f:
-                json_data = json.load(f)
-            
-            metadata = {}            
-            if scanner_metadata:
-                for tag in scanner_metadata:
-                    metadata[tag] = json_data.get(tag, None)
-           
-            # get sub and ses from path
-            parts = json_file.split(os.sep)
-            sub = [part.split("-")[1] for part in parts if part.startswith('sub-')]
-            ses = [part.split("-")[1] for part in parts if part.startswith('ses-')]
-            acq = [part.split("-")[1] for part in parts if part.startswith('acq-')]
-
-            metadata['sub'] = sub[0] if sub else None
-            metadata['ses'] = ses[0] if ses else None
-            metadata['acq'] = acq[0] if acq else None
-            
-            metadata_list.append(metadata)
-
-        metadata_df = pd.DataFrame(metadata_list)
-
-        # ensure sub, ses are strings
-        metadata_df['sub'] = metadata_df['sub'].astype(str)
-        metadata_df['ses'] = metadata_df['ses'].astype(str)
+        # normalized once (e.g. trailing slash), then joined with each relative path
+        ds_path = os.path.normpath(ds_path)
+
+        # get T1w json files directly from the dataset (bids to table does not list jsons...)
+        t1w_json_files = find_t1w_json_files(ds_path)
+        print(f"Number of T1w json files: {len(t1w_json_files)}")
+        sidecar_tags = scanner_metadata if scanner_metadata else []
+
+        cache_path = None
+        if cache_dir:
+            fingerprint = get_fingerprint([os.path.join(ds_path, f) for f in t1w_json_files], sidecar_tags)
+            cache_path = f"{cache_dir}/metadata_df-{fingerprint}.parquet"
+
+        if cache_path and os.path.exists(cache_path):
+            print(f"Loading cached metadata_df from {cache_path}")
+            metadata_df = pd.read_parquet(cache_path)
+
+        else:
+            read_sidecar = partial(read_sidecar_metadata, ds_path=ds_path, sidecar_tags=sidecar_tags)
+            # build columns directly instead of a list of per-file dicts
+            metadata_cols = {tag: [] for tag in sidecar_tags}
+            with ThreadPoolExecutor(max_workers=N_WORKERS) as executor:
+                for values in executor.map(read_sidecar, t1w_json_files):
+                    for tag, value in zip(sidecar_tags, values):
+                        metadata_cols[tag].append(value)
+
+            # get sub, ses and acq labels from paths (first match is the directory level for sub and ses)
+            paths = pd.Series(t1w_json_files, dtype='string[pyarrow]')
+            for entity in PATH_ENTITIES:
+                metadata_cols[entity] = paths.str.extract(rf'(?:^|[/_]){entity}-([a-zA-Z0-9]+)', expand=False)
+
+            metadata_df = pd.DataFrame(metadata_cols, index=paths.index)
+
+            # ensure sub, ses are strings
+            metadata_df['sub'] = metadata_df['sub'].astype(str)
+            metadata_df['ses'] = metadata_df['ses'].astype(str)
+
+            if cache_path:
+                save_cache(metadata_df, cache_path)
 
         if save_metadata_df:
             metadata_df.to_csv(bids_table_metadata_path, index=False, sep='\t')
@@ -93,7 +196,12 @@ def create_count_table(bids_df, groupby_cols, count_cols, save_table_path=None):
     Create a table with counts of a specific column grouped by specified columns.
     """
     print(f"Creating count table grouped by {groupby_cols} counting unique {count_cols}...")
-    count_df = bids_df.groupby(groupby_cols)[count_cols].nunique().reset_index()    
+    count_df = bids_df.groupby(groupby_cols, observed=True)[count_cols].nunique().reset_index()    
+
+    # categorical keys back to plain values, count criteria can compare them with >=
+    for col in groupby_cols:
+        if isinstance(count_df[col].dtype, pd.CategoricalDtype):
+            count_df[col] = count_df[col].astype(count_df[col].cat.categories.dtype)
 
     # rename count columns
     rename_dict = {col: f"n_{col}s" for col in count_cols}
@@ -110,23 +218,25 @@ def filter_by_datatype(bids_df, datatypes):
     """
     Filter dataframe based on specified datatypes.
     """
-    filtered_df = bids_df[bids_df['datatype'].isin(datatypes)]
-    participants_with_all_datatypes = filtered_df.groupby('sub')['datatype'].nunique()
-    participants_with_all_datatypes = participants_with_all_datatypes[participants_with_all_datatypes == len(datatypes)].index
+    # count the requested datatypes of each participant in a single pass, then mask once
+    is_requested = bids_df['datatype'].isin(datatypes)
+    n_datatypes = bids_df['datatype'].where(is_requested).groupby(bids_df['sub'], observed=True).transform('nunique')
 
-    filtered_df = filtered_df[filtered_df['sub'].isin(participants_with_all_datatypes)]
+    filtered_df = bids_df[is_requested & (n_datatypes == len(datatypes))]
     return filtered_df
 
 def filter_by_metadata(metadata_df, metadata_criteria):
     """
     Filter dataframe based on metadata criteria.
     """
-    participants_with_metadata = metadata_df['sub'].unique()
+    # keep participants matching each tag in at least one of their sidecars
+    keep = np.ones(len(metadata_df), dtype=bool)
     for tag, value in metadata_criteria.items():
         print(f"Filtering by metadata tag: {tag} with value: {value}")
-        participants_with_metadata = set(participants_with_metadata).intersection(set(metadata_df[metadata_df[tag].isin(value)]['sub']))
+        tag_match = metadata_df[tag].isin(value).groupby(metadata_df['sub'], dropna=False).transform('any')
+        keep &= tag_match.to_numpy(dtype=bool)
 
-    filtered_df = metadata_df[metadata_df['sub'].isin(participants_with_metadata)]
+    filtered_df = metadata_df[keep]
     return filtered_df
 
 def filter_by_protocol_counts(count_df, count_spec, force_exact_counts=False, save_table_path=None):
@@ -134,26 +244,36 @@ def filter_by_protocol_counts(count_df, count_spec, force_exact_counts=False, sa
     Filter participants based on criteria dictionary.
     """
 
-    # filter based on protocol specifications
-    criteria = []
-    for crit in count_spec:
-        mask = np.array([True]*len(count_df))
-        for tag, value in crit.items():    
-            if force_exact_counts:
-                mask &= (count_df[tag] == value) # exact match
-            else:
-                mask &= (count_df[tag] >= value) # greater than or equal to match
-                
-        criteria.append(mask.copy())
-
-    # check if all criteria are met for each participant and session
-    if len(criteria) > 0:
-        combined_criteria = np.logical_or.reduce(criteria)
-        count_df['criteria_met'] = combined_criteria
+    if len(count_spec) == 0:
+        # no criteria, nothing can match
+        count_df_filtered = pd.DataFrame({'ses': pd.Series([], dtype=count_df['ses'].dtype), 'participants': pd.Series([], dtype=object)})
+
     else:
-        count_df['criteria_met'] = False
-    
-    count_df_filtered = count_df[count_df['criteria_met']].groupby(['ses'])["sub"].unique().reset_index(name='participants')
+        # filter based on protocol specifications
+        # one row per criterion, each (tag, value) comparison is only evaluated once
+        criteria = np.ones((len(count_spec), len(count_df)), dtype=bool)
+        comparisons = {}
+        for i_crit, crit in enumerate(count_spec):
+            for tag, value in crit.items():
+                if (tag, value) not in comparisons:
+                    if force_exact_counts:
+                        comparison = (count_df[tag] == value) # exact match
+                    else:
+                        comparison = (count_df[tag] >= value) # greater than or equal to match
+                    comparisons[(tag, value)] = comparison.to_numpy(dtype=bool, na_value=False)
+                criteria[i_crit] &= comparisons[(tag, value)]
+
+        # check if any criterion is met for each participant and session
+        count_df['criteria_met'] = criteria.any(axis=0)
+
+        # subs are unique per session after dropping duplicates, so collect them as lists
+        count_df_filtered = (
+            count_df.loc[count_df['criteria_met'], ['ses', 'sub']]
+            .drop_duplicates()
+            .groupby('ses', observed=True)['sub']
+            .agg(list)
+            .reset_index(name='participants')
+        )
 
     # Save filtered df
     if save_table_path:
@@ -162,6 +282,13 @@ def filter_by_protocol_counts(count_df, count_spec, force_exact_counts=False, sa
     return count_df_filtered
 
 
+def write_participant_list(participant_list_path, participants):
+    """
+    Write participants to a text file (one per line) with a single write call.
+    """
+    with open(participant_list_path, 'w') as f:
+        f.write(''.join(f"{p}\n" for p in participants))
+
 def save_participant_lists(count_df_filtered, criteria_name, output_dir):
     """
     Save participant lists to text files based on filtered count dataframe.
@@ -171,20 +298,16 @@ def save_participant_lists(count_df_filtered, criteria_name, output_dir):
         return
 
     os.makedirs(f"{output_dir}/{criteria_name}", exist_ok=True)
-    sessions = count_df_filtered['ses'].tolist()
-    
-    for ses in sessions:
-        participants = count_df_filtered[count_df_filtered['ses'] == ses]['participants'].values[0]
-        participant_list_path = f"{output_dir}/{criteria_name}/participants_{ses}.txt"
-        
-        with open(participant_list_path, 'w') as f:
-            for p in participants:
-                f.write(f"{p}\n")
+    participant_list_paths = [f"{output_dir}/{criteria_name}/participants_{ses}.txt" for ses in count_df_filtered['ses']]
+
+    # one file per session, written concurrently
+    with ThreadPoolExecutor(max_workers=N_WORKERS) as executor:
+        list(executor.map(write_participant_list, participant_list_paths, count_df_filtered['participants']))
 
     print(f"Participant list for each session saved to {output_dir}/{criteria_name}")
 
 
-def run(nipoppy_ds_path, read_bids_df, read_metadata_df, bids_filter_spec_file, bids_filter_spec_name, output_dir):
+def run(nipoppy_ds_path, read_bids_df, read_metadata_df, bids_filter_spec_file, bids_filter_spec_name, output_dir, use_cache=False):
     """
     Main function to run the filtering process.
     """
@@ -192,10 +315,11 @@ def run(nipoppy_ds_path, read_bids_df, read_metadata_df, bids_filter_spec_file,
     os.makedirs(output_dir, exist_ok=True)
 
     # paths for intermediate files
-    bids_table_index_path = f"{output_dir}/bids2table_index.tsv"
+    bids_table_index_path = f"{output_dir}/bids2table_index.parquet"
     bids_table_metadata_path = f"{output_dir}/bids2table_metadata.tsv"
     single_shell_table_path = f"{output_dir}/single_shell_table.tsv"
     multi_shell_table_path = f"{output_dir}/multi_shell_table.tsv"
+    cache_dir = f"{output_dir}/cache" if use_cache else None
 
     # only save if not reading from preexisting files
     save_bids_df = not read_bids_df
@@ -204,19 +328,20 @@ def run(nipoppy_ds_path, read_bids_df, read_metadata_df, bids_filter_spec_file,
     print(f"Reading preexisting metadata_df: {read_metadata_df}, saving metadata_df: {save_metadata_df}")
 
     # create bids index table
-    bids_df = get_bids_df(bid_ds_path, bids_table_index_path, read_bids_df=read_bids_df, save_bids_df=save_bids_df)
+    bids_df = get_bids_df(bid_ds_path, bids_table_index_path, read_bids_df=read_bids_df, save_bids_df=save_bids_df, cache_dir=cache_dir)
 
     # cast sub, ses to string
     bids_df['sub'] = bids_df['sub'].astype(str)
     bids_df['ses'] = bids_df['ses'].astype(str)
 
+    # dictionary-encode key columns so groupby/isin hash integer codes instead of strings
+    for col in CATEGORICAL_COLS:
+        bids_df[col] = bids_df[col].astype('category')
+
     # number of participants
     n_subs = len(bids_df['sub'].unique())
     print(f"Number of participants: {n_subs}")    
 
-    # Per session bids participant counts
-    availability_df = bids_df.groupby(['ses'])['sub'].nunique().reset_index(name='total_participants')
-
     # read filter specifications
     with open(bids_filter_spec_file, 'r') as f:
         filter_spec_dict = json.load(f)  
@@ -228,7 +353,7 @@ def run(nipoppy_ds_path, read_bids_df, read_metadata_df, bids_filter_spec_file,
 
     # create scanner metadata table
     scanner_metadata = filter_spec["scanner_metadata"]["sidecar_tags"]
-    metadata_df = get_scanner_metadata(bid_ds_path, bids_df, bids_table_metadata_path, scanner_metadata, read_metadata_df=read_metadata_df, save_metadata_df=save_metadata_df)
+    metadata_df = get_scanner_metadata(bid_ds_path, bids_table_metadata_path, scanner_metadata, read_metadata_df=read_metadata_df, save_metadata_df=save_metadata_df, cache_dir=cache_dir)
 
     # cast sub, ses to string
     metadata_df['sub'] = metadata_df['sub'].astype(str)
@@ -243,23 +368,25 @@ def run(nipoppy_ds_path, read_bids_df, read_metadata_df, bids_filter_spec_file,
     # check if sanner metadata criteria is provided
     if filter_spec["criteria"]["scanner_metadata"]:
         metadata_criteria = filter_spec["criteria"]["scanner_metadata"]["sidecar_tags"]
-        filter_df = filter_by_metadata(metadata_df, metadata_criteria)
+        metadata_filter_df = filter_by_metadata(metadata_df, metadata_criteria)
     else:
         print("No scanner metadata criteria provided, skipping metadata filtering.")
-        filter_df = metadata_df.copy()
+        metadata_filter_df = metadata_df
 
-    metadata_participants = filter_df['sub'].unique()
-    
-    metadata_availability_df = filter_df.groupby(['ses'])['sub'].nunique().reset_index(name='metadata_participants')
-    availability_df = availability_df.merge(metadata_availability_df, on='ses', how='left')
+    metadata_participants = metadata_filter_df['sub'].unique()
 
     # filter bids_df by datatypes
     datatypes = filter_spec["criteria"]["datatypes"]
-    filter_df = filter_by_datatype(bids_df, datatypes)
-    datatype_participants = filter_df['sub'].unique()
-
-    datatype_availability_df = filter_df.groupby(['ses'])['sub'].nunique().reset_index(name='datatype_participants')
-    availability_df = availability_df.merge(datatype_availability_df, on='ses', how='left')
+    datatype_filter_df = filter_by_datatype(bids_df, datatypes)
+    datatype_participants = datatype_filter_df['sub'].unique()
+
+    # Per session participant counts for each filter, left-merged onto the BIDS sessions
+    availability_df = bids_df.groupby('ses', observed=True)['sub'].nunique().reset_index(name='total_participants')
+    availability_df['ses'] = availability_df['ses'].astype(str)
+    for col, df in [('metadata_participants', metadata_filter_df), ('datatype_participants', datatype_filter_df)]:
+        counts = df.groupby('ses', observed=True)['sub'].nunique().reset_index(name=col)
+        counts['ses'] = counts['ses'].astype(str)
+        availability_df = availability_df.merge(counts, on='ses', how='left')
    
     # Broader filter prior to count table based on datatype specific protocol counts
     count_participants = set(datatype_participants).intersection(set(metadata_participants))
@@ -297,6 +424,7 @@ if __name__ == "__main__":
     parser.add_argument('--ds_path', type=str, default=None, help='Path to the Nipoppy dataset.')
     parser.add_argument('--read_bids_df', action='store_true', help='Read bids_df from previously saved file.')
     parser.add_argument('--read_metadata_df', action='store_true', help='Read metadata_df from previously saved file.')
+    parser.add_argument('--use_cache', action='store_true', help='Reuse bids_df and metadata_df from a previous run (in <output_dir>/cache) if the dataset has not changed.')
     parser.add_argument('--bids_filter_spec_file', type=str, default=None, help='Path to the bids filter specification JSON file.')
     parser.add_argument('--bids_filter_spec_name', type=str, help='filter name from the specification file.')
     parser.add_argument('--output_dir', type=str, default=None, help='Path to save participant lists and tables.')
@@ -305,10 +433,11 @@ if __name__ == "__main__":
     ds_path = args.ds_path
     read_bids_df = args.read_bids_df
     read_metadata_df = args.read_metadata_df
+    use_cache = args.use_cache
     bids_filter_spec_file = args.bids_filter_spec_file
     bids_filter_spec_name = args.bids_filter_spec_name
     output_dir = args.output_dir
 
-    run(ds_path, read_bids_df, read_metadata_df, bids_filter_spec_file, bids_filter_spec_name, output_dir)
+    run(ds_path, read_bids_df, read_metadata_df, bids_filter_spec_file, bids_filter_spec_name, output_dir, use_cache=use_cache)
 
     
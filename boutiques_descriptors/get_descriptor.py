@@ -1,7 +1,9 @@
 #!/usr/bin/env python
 import argparse
+import re
 from importlib import import_module
 from pathlib import Path
+from typing import Optional
 import boutiques
 
 NAME_FIELD = "name"
@@ -21,7 +23,51 @@ TYPE_NUMBER = "Number"
 TYPE_FLAG = "Flag"
 TYPE_STRING = "String"
 
-def process_descriptor(parser, tool_name, tool_version):
+# input IDs that need tool-specific fixes
+FMRIPREP_LIST_IDS = frozenset({"output_spaces"})
+FMRIPREP_NUMBER_IDS = frozenset({"aggr_ses_reports"})
+FMRIPREP_FLAG_IDS = frozenset(
+    {
+        "no_msm",
+        "use_aroma",
+        "aroma_err_on_warn",
+        "fmap_no_demean",
+        "no_submm_recon",
+        "fs_no_reconall",
+        "version",
+    }
+)
+XCP_D_FLAG_IDS = frozenset({"disable_bandpass_filter", "skip_dcan_qc"})
+XCP_D_NUMBER_IDS = frozenset({"head_radius", "min_coverage"})
+MRIQC_FLAG_IDS = frozenset({"version"})
+QSIPREP_NUMBER_IDS = frozenset({"nprocs", "omp_nthreads"})
+QSIPREP_FLAG_IDS = frozenset({"fmap_no_demean", "version", "longitudinal"})
+
+# inputs whose pathlib.Path default values are deleted
+FIELDS_TO_CHECK = frozenset({"work_dir", "output_dir", "template"})
+
+# tools with the Nipreps 'verbose_count' input
+NIPREPS_TOOLS = frozenset({"fmriprep", "mriqc", "qsiprep", "xcp_d"})
+
+# tool name -> (parser submodule relative to the tool's package, parser function)
+PARSER_BUILDERS = {
+    "fmriprep": ("cli.parser", "_build_parser"),
+    "mriqc": ("cli.parser", "_build_parser"),
+    "xcp_d": ("cli.parser", "_build_parser"),
+    "halfpipe": ("cli.parser", "build_parser"),
+    "heudiconv": ("cli.run", "get_parser"),
+    "dcm2bids": ("cli.dcm2bids", "_build_arg_parser"),
+    "dcm2bids_helper": ("cli.dcm2bids_helper", "_build_arg_parser"),
+    "bidsmapper": ("cli._bidsmapper", "get_parser"),
+    "bidseditor": ("cli._bidseditor", "get_parser"),
+    "bidscoiner": ("cli._bidscoiner", "get_parser"),
+    # older versions of qsiprep, newer ones are handled in get_descriptor
+    "qsiprep": ("cli.run", "get_parser"),
+}
+
+def process_descriptor(
+    parser: argparse.ArgumentParser, tool_name: str, tool_version: str
+) -> boutiques.creator.CreateDescriptor:
     new_descriptor = boutiques.creator.CreateDescriptor(
         parser,
         execname=tool_name,
@@ -34,7 +80,6 @@ def process_descriptor(parser, tool_name, tool_version):
     # print(new_descriptor.descriptor)
 
     # fix errors
-    FIELDS_TO_CHECK = ["work_dir", "output_dir", "template"]
     TO_RENAME_BY_PIPELINE = {
         "fmriprep": [
             ("memory_gb", "mem"),
@@ -55,39 +100,41 @@ def process_descriptor(parser, tool_name, tool_version):
             ("dcan_qc", "skip_dcan_qc")
         ] 
     }
+    # old ID -> new ID lookup for this tool
+    rename_map: dict[str, str] = dict(TO_RENAME_BY_PIPELINE.get(tool_name, []))
+    # old ID -> (old, new) upper-case IDs, as they appear in the value keys
+    key_rename_map: dict[str, tuple[str, str]] = {
+        old_id: (old_id.upper(), new_id.upper())
+        for old_id, new_id in rename_map.items()
+    }
+    key_renames: dict[str, str] = {}  # applied to the command line after the loop
     I_INPUT_BBR = None  # may need to be deleted/replaced for fMRIPrep
     for i_input, input_object in enumerate(new_descriptor.descriptor[INPUTS_FIELD]):
+        input_id = input_object[ID_FIELD]
 
         # delete default values that are pathlib.Path objects
-        for field_to_check in FIELDS_TO_CHECK:
-            if input_object[ID_FIELD] == field_to_check and isinstance(
-                input_object.get(DEFAULT_VALUE_FIELD), Path
-            ):
-                print(
-                    f"Deleting default value for {field_to_check} ({input_object[DEFAULT_VALUE_FIELD]})"
-                )
-                del input_object[DEFAULT_VALUE_FIELD]
+        default_value = input_object.get(DEFAULT_VALUE_FIELD)
+        if input_id in FIELDS_TO_CHECK and isinstance(default_value, Path):
+            print(f"Deleting default value for {input_id} ({default_value})")
+            del input_object[DEFAULT_VALUE_FIELD]
 
         # rename some inputs
-        if tool_name in TO_RENAME_BY_PIPELINE:
-            for old_id, new_id in TO_RENAME_BY_PIPELINE[tool_name]:
-                if input_object[ID_FIELD] == old_id:
-                    print(f"Renaming {old_id} -> {new_id}")
-                    input_object[ID_FIELD] = new_id
-                    input_object[NAME_FIELD] = new_id
-                    old_key = str(input_object[KEY_FIELD])
-                    new_key = old_key.lower().replace(old_id, new_id).upper()
-                    input_object[KEY_FIELD] = new_key
-                    new_descriptor.descriptor[COMMAND_LINE_FIELD] = (
-                        new_descriptor.descriptor[COMMAND_LINE_FIELD].replace(
-                            old_key, new_key
-                        )
-                    )
+        if input_id in rename_map:
+            old_id = input_id
+            new_id = rename_map[old_id]
+            print(f"Renaming {old_id} -> {new_id}")
+            input_object[ID_FIELD] = new_id
+            input_object[NAME_FIELD] = new_id
+            input_id = new_id
+            old_key = str(input_object[KEY_FIELD])
+            new_key = old_key.replace(*key_rename_map[old_id])
+            input_object[KEY_FIELD] = new_key
+            key_renames[old_key] = new_key
 
         # delete default values that are ==SUPPRESS==
         if input_object.get(DEFAULT_VALUE_FIELD) == "==SUPPRESS==":
             print(
-                f"Deleting default value for {input_object[ID_FIELD]} ({input_object[DEFAULT_VALUE_FIELD]})"
+                f"Deleting default value for {input_id} ({input_object[DEFAULT_VALUE_FIELD]})"
             )
             del input_object[DEFAULT_VALUE_FIELD]
 
@@ -99,7 +146,7 @@ def process_descriptor(parser, tool_name, tool_version):
             ]
             if len(tmp) != len(input_object[CHOICES_FIELD]):
                 print(
-                    f"Removed None choice for {input_object[ID_FIELD]}: {tmp} -> {input_object[CHOICES_FIELD]}"
+                    f"Removed None choice for {input_id}: {tmp} -> {input_object[CHOICES_FIELD]}"
                 )
         except KeyError:
             pass
@@ -111,118 +158,107 @@ def process_descriptor(parser, tool_name, tool_version):
         # tool-specific fixes
         if tool_name == "fmriprep":
             # lists
-            if input_object[ID_FIELD] in ["output_spaces"]:
+            if input_id in FMRIPREP_LIST_IDS:
                 input_object[LIST_FIELD] = True
                 print(
-                    f'Setting "{LIST_FIELD}" field to True for {input_object[ID_FIELD]}'
+                    f'Setting "{LIST_FIELD}" field to True for {input_id}'
                 )
             # type
-            if input_object[ID_FIELD] in ["aggr_ses_reports"]:
+            if input_id in FMRIPREP_NUMBER_IDS:
                 input_object[TYPE_FIELD] = TYPE_NUMBER
                 print(
-                    f'Setting "{TYPE_FIELD}" field to {TYPE_NUMBER} for {input_object[ID_FIELD]}'
+                    f'Setting "{TYPE_FIELD}" field to {TYPE_NUMBER} for {input_id}'
                 )
-            if input_object[ID_FIELD] in [
-                "no_msm",
-                "use_aroma",
-                "aroma_err_on_warn",
-                "fmap_no_demean",
-                "no_submm_recon",
-                "fs_no_reconall",
-                "version",
-            ]:
+            if input_id in FMRIPREP_FLAG_IDS:
                 input_object[TYPE_FIELD] = TYPE_FLAG
                 print(
-                    f'Setting "{TYPE_FIELD}" field to {TYPE_FLAG} for {input_object[ID_FIELD]}'
+                    f'Setting "{TYPE_FIELD}" field to {TYPE_FLAG} for {input_id}'
                 )
                 if DEFAULT_VALUE_FIELD in input_object:
                     print(
-                        f"Deleting default value for {input_object[ID_FIELD]} ({input_object[DEFAULT_VALUE_FIELD]})"
+                        f"Deleting default value for {input_id} ({input_object[DEFAULT_VALUE_FIELD]})"
                     )
                     del input_object[DEFAULT_VALUE_FIELD]
             # fMRIPrep CLI has --force-bbr and --force-no-bbr flags
             # they are both configured to have dest='use_bbr', and the Boutiques
             # descriptor builder only keeps the first one
-            if input_object[ID_FIELD] == "force_bbr":
+            if input_id == "force_bbr":
                 I_INPUT_BBR = i_input
 
         elif tool_name == "xcp_d":
-            if input_object[ID_FIELD] in [
-                "disable_bandpass_filter",
-                "skip_dcan_qc"
-            ]:
+            if input_id in XCP_D_FLAG_IDS:
                 input_object[TYPE_FIELD] = TYPE_FLAG
                 print(
-                    f'Setting "{TYPE_FIELD}" field to {TYPE_FLAG} for {input_object[ID_FIELD]}'
+                    f'Setting "{TYPE_FIELD}" field to {TYPE_FLAG} for {input_id}'
                 )
                 if DEFAULT_VALUE_FIELD in input_object:
                     print(
-                        f"Deleting default value for {input_object[ID_FIELD]} ({input_object[DEFAULT_VALUE_FIELD]})"
+                        f"Deleting default value for {input_id} ({input_object[DEFAULT_VALUE_FIELD]})"
                     )
                     del input_object[DEFAULT_VALUE_FIELD]
             # type
-            if input_object[ID_FIELD] in ["head_radius", "min_coverage"]:
+            if input_id in XCP_D_NUMBER_IDS:
                 input_object[TYPE_FIELD] = TYPE_NUMBER
                 print(
-                    f'Setting "{TYPE_FIELD}" field to {TYPE_NUMBER} for {input_object[ID_FIELD]}'
+                    f'Setting "{TYPE_FIELD}" field to {TYPE_NUMBER} for {input_id}'
                 )
 
         elif tool_name == "mriqc":
-            if input_object[ID_FIELD] in ["version"]:
+            if input_id in MRIQC_FLAG_IDS:
                 input_object[TYPE_FIELD] = TYPE_FLAG
                 print(
-                    f'Setting "type" field to {TYPE_FLAG} for {input_object[ID_FIELD]}'
+                    f'Setting "type" field to {TYPE_FLAG} for {input_id}'
                 )
                 if DEFAULT_VALUE_FIELD in input_object:
                     print(
-                        f"Deleting default value for {input_object[ID_FIELD]} ({input_object[DEFAULT_VALUE_FIELD]})"
+                        f"Deleting default value for {input_id} ({input_object[DEFAULT_VALUE_FIELD]})"
                     )
                     del input_object[DEFAULT_VALUE_FIELD]
-            if input_object[ID_FIELD] == "analysis_level":
+            if input_id == "analysis_level":
                 if LIST_FIELD in input_object:
                     del input_object[LIST_FIELD]
-                    print(f'Deleting "{LIST_FIELD}" field for {input_object[ID_FIELD]}')
-            if input_object[ID_FIELD] == "modalities":
+                    print(f'Deleting "{LIST_FIELD}" field for {input_id}')
+            if input_id == "modalities":
                 input_object[LIST_FIELD] = True
                 print(
-                    f'Setting "{LIST_FIELD}" field to True for {input_object[ID_FIELD]}'
+                    f'Setting "{LIST_FIELD}" field to True for {input_id}'
                 )
         elif tool_name == "qsiprep":
             # wrong type
-            if input_object[ID_FIELD] in ["nprocs", "omp_nthreads"]:
+            if input_id in QSIPREP_NUMBER_IDS:
                 input_object[TYPE_FIELD] = TYPE_NUMBER
             # flags
-            if input_object[ID_FIELD] in ["fmap_no_demean", "version", "longitudinal"]:
+            if input_id in QSIPREP_FLAG_IDS:
                 input_object[TYPE_FIELD] = TYPE_FLAG
                 print(
-                    f'Setting "type" field to {TYPE_FLAG} for {input_object[ID_FIELD]}'
+                    f'Setting "type" field to {TYPE_FLAG} for {input_id}'
                 )
                 if DEFAULT_VALUE_FIELD in input_object:
                     print(
-                        f"Deleting default value for {input_object[ID_FIELD]} ({input_object[DEFAULT_VALUE_FIELD]})"
+                        f"Deleting default value for {input_id} ({input_object[DEFAULT_VALUE_FIELD]})"
                     )
                     del input_object[DEFAULT_VALUE_FIELD]
         elif tool_name == "heudiconv":
-            if input_object[ID_FIELD] == "bids_options":
+            if input_id == "bids_options":
                 input_object[LIST_FIELD] = True
                 print(
-                    f'Setting "{LIST_FIELD}" field to True for {input_object[ID_FIELD]}'
+                    f'Setting "{LIST_FIELD}" field to True for {input_id}'
                 )
 
         # Nipreps tools 'verbose_count' input
-        if tool_name in ["fmriprep", "mriqc", "qsiprep", "xcp_d"]:
-            if input_object[ID_FIELD] == "verbose_count":
+        if tool_name in NIPREPS_TOOLS:
+            if input_id == "verbose_count":
                 input_object[CHOICES_FIELD] = ["-v", "-vv", "-vvv"]
-                print(f'Setting "choices" field for {input_object[ID_FIELD]}')
+                print(f'Setting "choices" field for {input_id}')
                 if FLAG_FIELD in input_object:
                     print(
-                        f"Deleting flag for {input_object[ID_FIELD]} ({input_object[FLAG_FIELD]})"
+                        f"Deleting flag for {input_id} ({input_object[FLAG_FIELD]})"
                     )
                     del input_object[FLAG_FIELD]
 
         if isinstance(input_object.get(DEFAULT_VALUE_FIELD), Path):
             print(
-                f"WARNING: pathlib.Path default value for {input_object[ID_FIELD]}: {input_object[DEFAULT_VALUE_FIELD]}"
+                f"WARNING: pathlib.Path default value for {input_id}: {input_object[DEFAULT_VALUE_FIELD]}"
             )
 
         if (
@@ -230,7 +266,7 @@ def process_descriptor(parser, tool_name, tool_version):
             and input_object.get(DEFAULT_VALUE_FIELD) is True
         ):
             print(
-                f"WARNING: String with default value True, should check: {input_object[ID_FIELD]}"
+                f"WARNING: String with default value True, should check: {input_id}"
             )
 
         if (
@@ -238,16 +274,29 @@ def process_descriptor(parser, tool_name, tool_version):
             and input_object.get(DEFAULT_VALUE_FIELD) is True
         ):
             print(
-                f"WARNING: Flag with default value True, should check: {input_object[ID_FIELD]}"
+                f"WARNING: Flag with default value True, should check: {input_id}"
             )
 
         if FLAG_FIELD in input_object:
             snake_case_flag = input_object[FLAG_FIELD].lstrip("-").replace("-", "_")
-            if snake_case_flag != input_object[ID_FIELD]:
+            if snake_case_flag != input_id:
                 print(
-                    f"WARNING: ID and flag do not match, rename {input_object[ID_FIELD]} -> {snake_case_flag}?"
+                    f"WARNING: ID and flag do not match, rename {input_id} -> {snake_case_flag}?"
                 )
 
+    # rename value keys in the command line in a single pass
+    if key_renames:
+        pattern = re.compile(
+            "|".join(
+                re.escape(old_key)
+                for old_key in sorted(key_renames, key=len, reverse=True)
+            )
+        )
+        new_descriptor.descriptor[COMMAND_LINE_FIELD] = pattern.sub(
+            lambda match: key_renames[match.group(0)],
+            new_descriptor.descriptor[COMMAND_LINE_FIELD],
+        )
+
     if I_INPUT_BBR is not None:
         print("Adding entry for --force-no-bbr")
         # sanity check that the existing entry is what we think it is
@@ -279,50 +328,29 @@ def process_descriptor(parser, tool_name, tool_version):
 
     return new_descriptor
 
-def get_descriptor(tool_name, module_name, tool_version):
+def get_descriptor(
+    tool_name: str, module_name: Optional[str], tool_version: Optional[str]
+):
 
     if module_name is None:
         module_name = tool_name
 
     try:
         module = import_module(module_name)
-        if tool_name in ["fmriprep", "mriqc", "xcp_d"]:
-            path_parser_module = module_name
-            for submodule_name in ("cli", "parser"):
-                path_parser_module = f"{path_parser_module}.{submodule_name}"
-                parser_module = import_module(path_parser_module)
-            parser = parser_module._build_parser()
-        elif tool_name in ["halfpipe"]:
-            path_parser_module = f"{module_name}.cli.parser"
-            parser_module = import_module(path_parser_module)
-            parser = parser_module.build_parser()
-        elif tool_name in ["heudiconv"]:
-            path_parser_module = f"{module_name}.cli.run"
-            parser_module = import_module(path_parser_module)
-            parser = parser_module.get_parser()
-        elif tool_name in ["dcm2bids", "dcm2bids_helper"]:
-            path_parser_module = f"{module_name}.cli.{tool_name}"
-            parser_module = import_module(path_parser_module)
-            parser = parser_module._build_arg_parser()
-        elif tool_name in ["bidsmapper", "bidseditor", "bidscoiner"]:
-            path_parser_module = f"{module_name}.cli._{tool_name}"
-            parser_module = import_module(path_parser_module)
-            parser = parser_module.get_parser()
-        elif tool_name in ["qsiprep"]:
-            # older versions
-            try:
-                path_parser_module = f"{module_name}.cli.run"
-                parser_module = import_module(path_parser_module)
-                parser = parser_module.get_parser()
-            # newer versions
-            except AttributeError:
-                path_parser_module = f"{module_name}.cli.parser"
-                parser_module = import_module(path_parser_module)
-                parser = parser_module._build_parser()
-        else:
+        if tool_name not in PARSER_BUILDERS:
             raise RuntimeError(
                 f"Unable to get parser for {tool_name}. Check this script and make necessary changes."
             )
+        submodule_name, build_parser_name = PARSER_BUILDERS[tool_name]
+        try:
+            parser_module = import_module(f"{module_name}.{submodule_name}")
+            parser = getattr(parser_module, build_parser_name)()
+        # newer versions of qsiprep
+        except AttributeError:
+            if tool_name != "qsiprep":
+                raise
+            parser_module = import_module(f"{module_name}.cli.parser")
+            parser = parser_module._build_parser()
     except Exception as exception:
         print(
             f"Error while importing modules dynamically. Make sure that {module_name} has been installed "
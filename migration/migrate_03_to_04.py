@@ -2,10 +2,19 @@
 
 import argparse
 import datetime
+import errno
 import json
+import os
 import shutil
+from dataclasses import dataclass
 from pathlib import Path
-from typing import Tuple
+from typing import Collection, Dict, List, Optional, Tuple, Union
+
+# orjson parses bytes directly and is several times faster than json
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads  # type: ignore[assignment]
 
 TIMESTAMP = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
 PIPELINE_STEP_PATH_PREFIX = (
@@ -16,37 +25,187 @@ PIPELINE_TYPE_TO_CONFIG_FIELD_MAP = {
     "processing": "PROC_PIPELINES",
     "extraction": "EXTRACTION_PIPELINES",
 }
+PIPELINE_TYPES = frozenset(PIPELINE_TYPE_TO_CONFIG_FIELD_MAP)
+# pipeline files that are copied instead of hardlinked because users edit them
+COPIED_FILE_SUFFIXES = (".json",)
+# os.link errors for which a regular copy is made instead
+LINK_UNSUPPORTED_ERRNOS = frozenset({errno.EXDEV, errno.EPERM, errno.ENOTSUP})
+
+
+def link_or_copy(src: Union[str, os.PathLike[str]], dst: Union[str, os.PathLike[str]]):
+    # hardlink if possible (no data is copied), otherwise fall back to a real copy
+    # across filesystems or on filesystems without hardlink support
+    try:
+        os.link(src, dst)
+    except OSError as exception:
+        if exception.errno not in LINK_UNSUPPORTED_ERRNOS:
+            raise
+        shutil.copy2(src, dst)
+
+
+def link_entry(entry: Union[os.DirEntry[str], Path], dst: Union[str, os.PathLike[str]]):
+    # recreate a directory entry at dst, hardlinking files instead of copying them
+    # except for the JSON files that users edit in place (descriptors, invocations,
+    # tracker configs, etc.): hardlinks share data, so editing them would also
+    # change the backup
+    # symlinks are followed (pipeline directories move one level deeper, so relative
+    # links could otherwise break)
+    if entry.is_dir():
+        link_tree(entry, dst)
+    elif entry.name.endswith(COPIED_FILE_SUFFIXES):
+        shutil.copy2(entry, dst)
+    else:
+        # os.link does not follow symlinks on all platforms
+        link_or_copy(os.path.realpath(entry) if entry.is_symlink() else entry, dst)
+
+
+def link_tree(
+    dpath_src: Union[str, os.PathLike[str]], dpath_dst: Union[str, os.PathLike[str]]
+):
+    os.makedirs(dpath_dst, exist_ok=True)
+    with os.scandir(dpath_src) as entries:
+        for entry in entries:
+            link_entry(entry, os.path.join(dpath_dst, entry.name))
+
+
+@dataclass
+class MkDir:
+    path: Path
+
+    def __str__(self) -> str:
+        return f"Creating directory {self.path}"
+
+    def execute(self):
+        self.path.mkdir()
+
+    def undo(self):
+        self.path.rmdir()
 
 
-def get_extra_pipelines_subdirs(dpath_pipelines: Path) -> set:
-    pipeline_types = PIPELINE_TYPE_TO_CONFIG_FIELD_MAP.keys()
+@dataclass
+class Rename:
+    src: Path
+    dst: Path
+
+    def __str__(self) -> str:
+        return f"Renaming {self.src} -> {self.dst}"
+
+    def execute(self):
+        self.src.rename(self.dst)
+
+    def undo(self):
+        self.dst.rename(self.src)
+
+
+@dataclass
+class LinkTree:
+    src: Path
+    dst: Path
+
+    def __str__(self) -> str:
+        return f"Linking {self.src} -> {self.dst}"
+
+    def execute(self):
+        existed = os.path.lexists(self.dst)
+        try:
+            link_entry(self.src, self.dst)
+        except Exception:
+            # do not leave a partial tree behind (but never remove a preexisting one)
+            if not existed and os.path.lexists(self.dst):
+                self.undo()
+            raise
+
+    def undo(self):
+        if self.dst.is_dir() and not self.dst.is_symlink():
+            shutil.rmtree(self.dst)
+        else:
+            self.dst.unlink()
 
-    if set(pipeline_types).issubset(
-        found_subdirs := set(
-            path.name for path in dpath_pipelines.iterdir() if path.is_dir()
+
+@dataclass
+class WriteJson:
+    path: Path
+    payload: dict
+
+    def __str__(self) -> str:
+        return f"Writing config to {self.path}"
+
+    @property
+    def text(self) -> str:
+        return json.dumps(self.payload, indent=4)
+
+    def execute(self):
+        existed = os.path.lexists(self.path)
+        try:
+            self.path.write_text(self.text)
+        except Exception:
+            if not existed and os.path.lexists(self.path):
+                self.undo()
+            raise
+
+    def undo(self):
+        self.path.unlink()
+
+
+Operation = Union[MkDir, Rename, LinkTree, WriteJson]
+
+
+def has_match(dpath: Path, patterns: Tuple[str, ...]) -> bool:
+    # stop at the first entry whose name contains any of the patterns
+    with os.scandir(dpath) as entries:
+        return any(
+            any(pattern in entry.name for pattern in patterns) for entry in entries
         )
-    ):
-        return found_subdirs - set(pipeline_types)
+
+
+def scan_pipelines(dpath_pipelines: Path) -> Dict[str, List[str]]:
+    # map subdirectory names to the names of their own subdirectories
+    # (only listed for pipeline type subdirectories, the others are not inspected)
+    found_subdirs: Dict[str, List[str]] = {}
+    with os.scandir(dpath_pipelines) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                found_subdirs[entry.name] = []
+
+    for pipeline_type in PIPELINE_TYPE_TO_CONFIG_FIELD_MAP.keys():
+        if pipeline_type in found_subdirs:
+            with os.scandir(dpath_pipelines / pipeline_type) as entries:
+                found_subdirs[pipeline_type] = [
+                    entry.name for entry in entries if entry.is_dir()
+                ]
+
+    return found_subdirs
+
+
+def get_extra_pipelines_subdirs(found_subdirs: Collection[str]) -> set:
+    if PIPELINE_TYPES.issubset(found_subdirs):
+        return set(found_subdirs) - PIPELINE_TYPES
 
     return set()
 
 
-def check_already_migrated(dpath_dataset: Path) -> Tuple[int, int, int]:
-    pipeline_types = PIPELINE_TYPE_TO_CONFIG_FIELD_MAP.keys()
+def check_already_migrated(
+    dpath_dataset: Path, found_subdirs: Optional[dict] = None
+) -> Tuple[int, int, int]:
     dpath_pipelines = dpath_dataset / "pipelines"
+    if found_subdirs is None:
+        found_subdirs = scan_pipelines(dpath_pipelines)
 
     found_already_migrated_pipelines = False
 
-    if extra_subdirs := get_extra_pipelines_subdirs(dpath_pipelines):
+    if extra_subdirs := get_extra_pipelines_subdirs(found_subdirs):
         print(
             f"WARNING: Found unexpected subdirectories in {dpath_pipelines}: "
             f"{extra_subdirs}. They should be deleted."
         )
 
-    for pipeline_type in pipeline_types:
+    for pipeline_type in PIPELINE_TYPE_TO_CONFIG_FIELD_MAP.keys():
         if (
-            n_pipelines := len(
-                list(dpath_pipelines.glob(f"{pipeline_type}/*/config.json"))
+            n_pipelines := sum(
+                os.path.lexists(
+                    os.path.join(dpath_pipelines, pipeline_type, dname, "config.json")
+                )
+                for dname in found_subdirs.get(pipeline_type, [])
             )
         ) > 0:
             found_already_migrated_pipelines = True
@@ -57,12 +216,28 @@ def check_already_migrated(dpath_dataset: Path) -> Tuple[int, int, int]:
     return found_already_migrated_pipelines
 
 
-def migrate_pipeline(
+def list_dir(dpath: Path, listings: dict) -> set:
+    # list each directory only once, all existence checks share the listings
+    if dpath not in listings:
+        try:
+            with os.scandir(dpath) as entries:
+                listings[dpath] = {entry.name for entry in entries}
+        except FileNotFoundError:
+            listings[dpath] = set()
+    return listings[dpath]
+
+
+def path_exists(path: Path, listings: dict) -> bool:
+    return path.name in list_dir(path.parent, listings)
+
+
+def plan_pipeline(
     pipeline_config: dict,
     pipeline_type: str,
     dpath_dataset: Path,
-    dry_run: bool = False,
-):
+    dpath_pipelines_backup: Path,
+    listings: dict,
+) -> List[Operation]:
     pipeline_name = pipeline_config["NAME"]
     pipeline_version = pipeline_config["VERSION"]
 
@@ -77,14 +252,19 @@ def migrate_pipeline(
         dpath_pipeline_current.parent / pipeline_type / dpath_pipeline_current.name
     )
 
-    if not dpath_pipeline_current.exists():
+    if not path_exists(dpath_pipeline_current, listings):
         raise FileNotFoundError(
             f"Pipeline directory not found: {dpath_pipeline_current}"
         )
-    if dpath_pipeline_new.exists():
+    if path_exists(dpath_pipeline_new, listings):
         raise FileExistsError(
             f"Pipeline directory already exists: {dpath_pipeline_new}"
         )
+    if path_exists(dpath_pipeline_current / "config.json", listings):
+        raise FileExistsError(
+            "Pipeline config file already exists: "
+            f"{dpath_pipeline_current / 'config.json'}"
+        )
 
     for i_step, step_config in enumerate(pipeline_config["STEPS"]):
         for field in [
@@ -95,41 +275,76 @@ def migrate_pipeline(
         ]:
             if field in step_config:
                 path = str(step_config[field])
-                if Path(path).name != path:
-                    path_stripped = path.removeprefix(PIPELINE_STEP_PATH_PREFIX)
-                    if path_stripped == path:
+                # only paths that are not bare file names need to be checked
+                if "/" in path or os.sep in path:
+                    if path.startswith(PIPELINE_STEP_PATH_PREFIX):
                         print(
-                            f"WARNING: Path for field {field} in step {i_step+1} "
-                            "should be relative to parent directory, "
-                            f"but current value is {path}"
+                            f"Removed {PIPELINE_STEP_PATH_PREFIX} prefix for "
+                            f"field {field}"
+                        )
+                        step_config[field] = path.removeprefix(
+                            PIPELINE_STEP_PATH_PREFIX
                         )
                     else:
                         print(
-                            f"Removed {PIPELINE_STEP_PATH_PREFIX} prefix for "
-                            f"field {field}"
+                            f"WARNING: Path for field {field} in step {i_step+1} "
+                            "should be relative to parent directory, "
+                            f"but current value is {path}"
                         )
-                    step_config[field] = path_stripped
 
-    # write pipeline config to dedicated file
-    fpath_pipeline_config = dpath_pipeline_current / "config.json"
-    if fpath_pipeline_config.exists():
-        raise FileExistsError(
-            f"Pipeline config file already exists: {fpath_pipeline_config}"
-        )
-    pipeline_config_json = json.dumps(pipeline_config, indent=4)
-    print(f"Writing pipeline config to {fpath_pipeline_config}")
-    if dry_run:
-        print(pipeline_config_json)
-    else:
-        fpath_pipeline_config.write_text(pipeline_config_json)
-
-    # rename pipeline directory
-    print(
-        f"Renaming pipeline directory: {dpath_pipeline_current} -> {dpath_pipeline_new}"
-    )
-    if not dry_run:
-        dpath_pipeline_new.parent.mkdir(parents=True, exist_ok=True)
-        dpath_pipeline_current.rename(dpath_pipeline_new)
+    # recreate the pipeline directory under the pipeline_type subdirectory
+    # then write the pipeline config to a dedicated file
+    return [
+        LinkTree(
+            dpath_pipelines_backup / dpath_pipeline_current.name, dpath_pipeline_new
+        ),
+        WriteJson(dpath_pipeline_new / "config.json", pipeline_config),
+    ]
+
+
+def validate_plan(plan: List[Operation], listings: dict):
+    # renames are the only operations on paths that exist before the migration
+    # no two operations can create the same path (e.g. a pipeline listed twice)
+    dpaths_created = set()
+    for operation in plan:
+        if isinstance(operation, Rename):
+            if not path_exists(operation.src, listings):
+                raise FileNotFoundError(f"File not found: {operation.src}")
+            if path_exists(operation.dst, listings):
+                raise FileExistsError(f"File already exists: {operation.dst}")
+            dpath_created = operation.dst
+        elif isinstance(operation, LinkTree):
+            dpath_created = operation.dst
+        else:
+            dpath_created = operation.path
+        if dpath_created in dpaths_created:
+            raise FileExistsError(
+                f"More than one operation would create {dpath_created}"
+            )
+        dpaths_created.add(dpath_created)
+
+
+def execute_plan(plan: List[Operation], dry_run: bool = False):
+    executed = []
+    try:
+        for operation in plan:
+            print(operation)
+            if dry_run:
+                if isinstance(operation, WriteJson):
+                    print(operation.text)
+                continue
+            operation.execute()
+            executed.append(operation)
+    except Exception:
+        print(f"Migration failed. Reverting {len(executed)} completed operations.")
+        # keep going if an operation cannot be undone, so that as much as possible
+        # of the original dataset is restored
+        for operation in reversed(executed):
+            try:
+                operation.undo()
+            except Exception as exception:
+                print(f"WARNING: Failed to revert operation ({operation}): {exception}")
+        raise
 
 
 def migrate_dataset(dpath_dataset: Path, dry_run: bool = False):
@@ -141,16 +356,24 @@ def migrate_dataset(dpath_dataset: Path, dry_run: bool = False):
     # check if the dataset is already migrated
     # i.e. if the pipelines directory contains subdirectories for each pipeline type
     # and no direct pipelines directories
-    if check_already_migrated(dpath_dataset):
+    found_subdirs = scan_pipelines(dpath_dataset / "pipelines")
+    if check_already_migrated(dpath_dataset, found_subdirs):
         print("The dataset seems to already have been migrated. Aborting.")
         return
 
+    # nothing is changed on disk until the full plan has been built and validated
+    # if any operation fails, the ones that were already executed are undone
+    plan: List[Operation] = []
+    listings = {}
+
     # create empty dotnipoppy directory
-    (dpath_dataset / ".nipoppy").mkdir(exist_ok=True)
+    dpath_dotnipoppy = dpath_dataset / ".nipoppy"
+    if not path_exists(dpath_dotnipoppy, listings):
+        plan.append(MkDir(dpath_dotnipoppy))
 
     # load the config file
-    config: dict = json.loads(
-        fpath_config.read_text().replace("UPDATE_DOUGHNUT", "UPDATE_STATUS")
+    config: dict = json_loads(
+        fpath_config.read_bytes().replace(b"UPDATE_DOUGHNUT", b"UPDATE_STATUS")
     )
 
     for field_to_remove in ["DATASET_NAME", "VISIT_IDS", "SESSION_IDS"]:
@@ -159,14 +382,17 @@ def migrate_dataset(dpath_dataset: Path, dry_run: bool = False):
             config.pop(field_to_remove)
 
     # make a backup of all original pipeline files
+    # the new pipelines directory is rebuilt from the backup with hardlinks
+    # (JSON files are copied), the backup itself is never modified
     dpath_pipelines = dpath_dataset / "pipelines"
     dpath_pipelines_backup = dpath_dataset / f"pipelines-{TIMESTAMP}"
-    print(f"Backing up original pipelines directory to {dpath_pipelines_backup}")
-    if not dry_run:
-        dpath_pipelines.rename(dpath_pipelines_backup)
-        shutil.copytree(dpath_pipelines_backup, dpath_pipelines)
+    plan.append(Rename(dpath_pipelines, dpath_pipelines_backup))
+    plan.append(MkDir(dpath_pipelines))
 
     # migrate the pipelines
+    plan_pipelines = []
+    dnames_pipelines = set()
+    pipeline_types_migrated = set()
     for pipeline_type, pipeline_list_field in PIPELINE_TYPE_TO_CONFIG_FIELD_MAP.items():
         if pipeline_list_field in config:
             for pipeline_config in config[pipeline_list_field]:
@@ -175,9 +401,24 @@ def migrate_dataset(dpath_dataset: Path, dry_run: bool = False):
                     f"Migrating {pipeline_type} pipeline: {pipeline_config['NAME']} "
                     f"{pipeline_config['VERSION']}"
                 )
-                migrate_pipeline(
-                    pipeline_config, pipeline_type, dpath_dataset, dry_run=dry_run
+                if (
+                    pipeline_type not in found_subdirs
+                    and pipeline_type not in pipeline_types_migrated
+                ):
+                    plan_pipelines.append(MkDir(dpath_pipelines / pipeline_type))
+                plan_pipelines.extend(
+                    plan_pipeline(
+                        pipeline_config,
+                        pipeline_type,
+                        dpath_dataset,
+                        dpath_pipelines_backup,
+                        listings,
+                    )
                 )
+                dnames_pipelines.add(
+                    f"{pipeline_config['NAME']}-{pipeline_config['VERSION']}"
+                )
+                pipeline_types_migrated.add(pipeline_type)
         else:
             print(f"No {pipeline_type} pipelines found in the config file.")
             continue
@@ -185,58 +426,65 @@ def migrate_dataset(dpath_dataset: Path, dry_run: bool = False):
         # remove pipeline configs
         config.pop(pipeline_list_field)
 
-    for extra_pipelines_subdir in get_extra_pipelines_subdirs(dpath_pipelines):
+    # the new layout only differs from the original one by the pipelines that were
+    # moved into the type subdirectories, anything else is carried over as-is
+    # except for unused pipelines
+    dnames_unused = set()
+    found_subdirs = (set(found_subdirs) - dnames_pipelines) | pipeline_types_migrated
+    for extra_pipelines_subdir in get_extra_pipelines_subdirs(found_subdirs):
         fpath_subdir: Path = dpath_pipelines / extra_pipelines_subdir
         dname_components = str(extra_pipelines_subdir).split("-")
-        if len(dname_components) > 1 and (
-            len(set(fpath_subdir.glob("*descriptor*"))) > 0
-            or len(set(fpath_subdir.glob("*tracker*"))) > 0
+        if len(dname_components) > 1 and has_match(
+            fpath_subdir, ("descriptor", "tracker")
         ):
             print(
                 f"Extra subdirectory found: {fpath_subdir}. This looks like an unused "
                 "pipeline. Deleting."
             )
-            if not dry_run:
-                shutil.rmtree(fpath_subdir)
+            dnames_unused.add(extra_pipelines_subdir)
         else:
             print(
                 f"WARNING: Found unexpected subdirectory {extra_pipelines_subdir} in "
                 f"{dpath_pipelines}"
             )
 
+    for dname in sorted(
+        list_dir(dpath_pipelines, listings) - dnames_pipelines - dnames_unused
+    ):
+        plan.append(LinkTree(dpath_pipelines_backup / dname, dpath_pipelines / dname))
+    plan.extend(plan_pipelines)
+
     print("-" * 80)
 
     # rename original file (keep as backup)
     fname_config_backup = fpath_config.name.replace(".json", f"-{TIMESTAMP}.json")
     fpath_config_backup = dpath_dataset / fname_config_backup
-    print(f"Backing up original config file to {fpath_config_backup}")
-    if not dry_run:
-        fpath_config.rename(fpath_config_backup)
+    plan.append(Rename(fpath_config, fpath_config_backup))
 
     # write the new config file
-    print(f"Writing new config file to {fpath_config}")
-    config_json = json.dumps(config, indent=4)
-    if dry_run:
-        print(config_json)
-    else:
-        fpath_config.write_text(config_json)
+    plan.append(WriteJson(fpath_config, config))
 
     # rename doughnut/imaging bagel files
     fpath_doughnut_orig = dpath_dataset / "sourcedata" / "imaging" / "doughnut.tsv"
     fpath_doughnut_new = (
         dpath_dataset / "sourcedata" / "imaging" / "curation_status.tsv"
     )
-    if fpath_doughnut_orig.exists():
-        print(f"Renaming {fpath_doughnut_orig} -> {fpath_doughnut_new}")
-        if not dry_run:
-            fpath_doughnut_orig.rename(fpath_doughnut_new)
+    if path_exists(fpath_doughnut_orig, listings):
+        plan.append(Rename(fpath_doughnut_orig, fpath_doughnut_new))
     fpath_bagel_orig = dpath_dataset / "derivatives" / "imaging_bagel.tsv"
     fpath_bagel_new = dpath_dataset / "derivatives" / "processing_status.tsv"
-    if fpath_bagel_orig.exists():
-        print(f"Renaming {fpath_bagel_orig} -> {fpath_bagel_new}")
-        if not dry_run:
-            fpath_bagel_orig.rename(fpath_bagel_new)
+    if path_exists(fpath_bagel_orig, listings):
+        plan.append(Rename(fpath_bagel_orig, fpath_bagel_new))
 
+    validate_plan(plan, listings)
+    execute_plan(plan, dry_run=dry_run)
+
+    if not dry_run:
+        print(
+            f"NOTE: Files in {dpath_pipelines} (other than JSON files) are hardlinked "
+            f"to the backup in {dpath_pipelines_backup}. Editing them in place will "
+            "also change the backup."
+        )
     print(
         f'Migration complete! Update to 0.4 ("pip install -U nipoppy") and try running '
         'a "nipoppy run" command with the "--simulate" flag to confirm'
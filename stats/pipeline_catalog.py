@@ -1,9 +1,12 @@
+import json
 import sys
-import httpx
+from operator import itemgetter
+from urllib.parse import urlencode
+from urllib.request import urlopen
 
 
 TIMEOUT = 10
-SIZE = 9999
+PAGE_SIZE = 200
 
 if len(sys.argv) > 1:
     query = f'{sys.argv[1]} AND metadata.subjects.subject:"Nipoppy"'
@@ -11,15 +14,29 @@ else:
     query = 'metadata.subjects.subject:"Nipoppy"'
 
 print(f'Using Zenodo query string: "{query}"')
-response = httpx.get(
-    "https://zenodo.org/api/records",
-    params={
-        "q": query,
-        "size": SIZE,
-    },
-    timeout=TIMEOUT,
-)
 
-records = response.json()["hits"]["hits"]
-n_downloads = sum([record["stats"]["downloads"] for record in records])
+# fetch one page at a time so that no result set is truncated
+# stop on the reported total rather than on a short page, since the server
+# may cap the page size below PAGE_SIZE
+n_downloads = 0
+n_records = 0
+page = 1
+while True:
+    url = "https://zenodo.org/api/records?" + urlencode(
+        {
+            "q": query,
+            "size": PAGE_SIZE,
+            "page": page,
+        }
+    )
+    with urlopen(url, timeout=TIMEOUT) as response:
+        hits = json.load(response)["hits"]
+
+    records = hits["hits"]
+    n_downloads += sum(map(itemgetter("downloads"), map(itemgetter("stats"), records)))
+    n_records += len(records)
+    if not records or n_records >= hits["total"]:
+        break
+    page += 1
+
 print(f"Total downloads for query '{query}': {n_downloads}")